@@ -1,9 +1,17 @@
 
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import numpy as np
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
 import pytz
 
 # Constants
@@ -13,86 +21,284 @@ PARAMETERS = {
     "Rainfall (PRECTOTCORR)": "PRECTOTCORR",
     "Wind Speed (WS10M)": "WS10M"
 }
+PARAMETER_LABELS = tuple(PARAMETERS)
 TIMEZONE = pytz.timezone("Asia/Riyadh")
+MAX_PLOT_POINTS = 2000
+MAX_FETCH_WORKERS = 16
+CACHE_DIR = Path("cache")
+NASA_POWER_URL = "https://power.larc.nasa.gov/api/temporal/hourly/point"
+NASA_POWER_FILL_VALUE = -999
+
+# Shared HTTP session with retries
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MAX_FETCH_WORKERS,
+    pool_maxsize=MAX_FETCH_WORKERS,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+    ),
+))
 
 # UI Layout
 st.set_page_config(layout="wide", page_title="NASA POWER Climate Dashboard")
 st.title("NASA POWER Climate Dashboard")
 st.markdown("Analyze and visualize hourly weather data for multiple stations.")
 
+@st.cache_resource(show_spinner=False)
+def load_stations():
+    return pd.read_parquet("stations.parquet", engine="pyarrow").dropna(subset=["Latitude", "Longitude"]).set_index("Station Name")
+
+@st.cache_resource(show_spinner=False)
+def load_station_coords():
+    stations = load_stations()
+    # Rounded to the precision of the cache file names
+    return {name: (round(lat, 4), round(lon, 4)) for name, lat, lon in zip(stations.index, stations["Latitude"], stations["Longitude"])}
+
 # Sidebar Controls
 with st.sidebar:
     st.header("User Input")
-    stations_df = pd.read_excel("stations.xlsx")
-    selected_stations = st.multiselect("Select Stations", options=stations_df["Station Name"].tolist())
+    selected_stations = st.multiselect("Select Stations", options=tuple(load_station_coords()))
     start_date = st.date_input("Start Date", value=datetime(2025, 1, 1))
     end_date = st.date_input("End Date", value=datetime.now(TIMEZONE).date() - timedelta(days=3))
-    selected_parameters = st.multiselect("Select Parameters", options=list(PARAMETERS.keys()), default=list(PARAMETERS.keys()))
+    selected_parameters = st.multiselect("Select Parameters", options=PARAMETER_LABELS, default=PARAMETER_LABELS)
     trigger = st.button("Load & Analyze")
 
-# Function to fetch data
-@st.cache_data(show_spinner=False)
-def fetch_nasa_power_data(lat, lon, start, end, param):
-    url = (
-        "https://power.larc.nasa.gov/api/temporal/hourly/point?"
-        f"parameters={param}&community=RE&longitude={lon}&latitude={lat}"
-        f"&start={start}&end={end}&format=JSON&time-standard=UTC"
+# Function to download data from the API
+def download_nasa_power_data(lat, lon, start, end, params):
+    query = {
+        "parameters": ",".join(params),
+        "community": "RE",
+        "longitude": lon,
+        "latitude": lat,
+        "start": start,
+        "end": end,
+        "format": "CSV",
+        "time-standard": "UTC",
+    }
+    response = SESSION.get(NASA_POWER_URL, params=query, timeout=(5, 60))
+    response.raise_for_status()
+    # The CSV body starts after a free-text header block closed by "-END HEADER-"
+    content = response.content
+    header_end = content.find(b"-END HEADER-")
+    if header_end == -1:
+        raise ValueError("NASA POWER response has no CSV header block")
+    skip_rows = content[:header_end].count(b"\n") + 1
+    column_types = {"YEAR": pa.int16(), "MO": pa.int8(), "DY": pa.int8(), "HR": pa.int8()}
+    column_types.update({param: pa.float32() for param in params})
+    table = pacsv.read_csv(
+        BytesIO(content),
+        read_options=pacsv.ReadOptions(skip_rows=skip_rows),
+        convert_options=pacsv.ConvertOptions(column_types=column_types),
     )
-    retries = 3
-    for _ in range(retries):
-        try:
-            response = requests.get(url, timeout=60)
-            if response.ok:
-                data = response.json()["properties"]["parameter"][param]
-                df = pd.DataFrame.from_dict(data, orient="index", columns=[param])
-                df.index = pd.to_datetime(df.index, format="%Y%m%d%H")
-                df.index = df.index.tz_localize("UTC").tz_convert("Asia/Riyadh")
-                return df
-        except Exception:
+    missing = [c for c in ("YEAR", "MO", "DY", "HR", *params) if c not in table.column_names]
+    if missing:
+        raise ValueError(f"NASA POWER response is missing columns: {', '.join(missing)}")
+    year, month, day, hour = (table.column(c).to_numpy() for c in ("YEAR", "MO", "DY", "HR"))
+    # Assemble timestamps with datetime64 arithmetic
+    months = (year - 1970).astype("datetime64[Y]") + (month - 1).astype("timedelta64[M]")
+    days = months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    timestamps = (days + hour.astype("timedelta64[h]")).astype("datetime64[ns]")
+    # The API returns UTC
+    index = pd.DatetimeIndex(timestamps, tz="UTC").tz_convert(TIMEZONE)
+    return pd.DataFrame({param: table.column(param).to_numpy() for param in params}, index=index)
+
+# Function to fetch data. Whole UTC months are cached per parameter as Parquet under cache/; other months are downloaded.
+@st.cache_data(show_spinner=False, ttl=timedelta(days=1), max_entries=256)
+def fetch_nasa_power_data(lat, lon, start, end, params):
+    start_day, end_day = pd.Timestamp(start), pd.Timestamp(end)
+    months = pd.period_range(start_day, end_day, freq="M")
+    whole_months = {m for m in months if m.start_time >= start_day and m.end_time.normalize() <= end_day}
+
+    def cache_path(param, month):
+        return CACHE_DIR / f"{lat:.4f}_{lon:.4f}_{param}_{month.strftime('%Y%m')}.parquet"
+
+    spans = []
+    for month in months:
+        missing = {p for p in params if month not in whole_months or not cache_path(p, month).exists()}
+        if not missing:
             continue
-    return pd.DataFrame()
+        if spans and spans[-1][1] == month - 1:
+            spans[-1][1] = month
+            spans[-1][2] |= missing
+        else:
+            spans.append([month, month, missing])
+
+    pieces = {p: [] for p in params}
+    downloaded = {p: set() for p in params}
+    for first, last, missing in spans:
+        span_params = [p for p in params if p in missing]
+        span_start, span_end = max(first.start_time, start_day), min(last.end_time.normalize(), end_day)
+        df = download_nasa_power_data(lat, lon, f"{span_start:%Y%m%d}", f"{span_end:%Y%m%d}", span_params)
+        for month in pd.period_range(first, last, freq="M"):
+            if month in whole_months:
+                in_month = (df.index >= month.start_time.tz_localize("UTC")) & (df.index <= month.end_time.tz_localize("UTC"))
+                CACHE_DIR.mkdir(exist_ok=True)
+                for p in span_params:
+                    month_df = df.loc[in_month, [p]]
+                    # -999 marks hours NASA has not published yet
+                    if (month_df[p] == NASA_POWER_FILL_VALUE).any():
+                        continue
+                    tmp_path = cache_path(p, month).with_suffix(f".{uuid4().hex}.tmp")
+                    try:
+                        month_df.to_parquet(tmp_path, compression="zstd")
+                    except Exception:
+                        tmp_path.unlink(missing_ok=True)
+                        raise
+                    tmp_path.replace(cache_path(p, month))
+            for p in span_params:
+                downloaded[p].add(month)
+        for p in span_params:
+            pieces[p].append(df[[p]])
+    for p in params:
+        pieces[p] += [pd.read_parquet(cache_path(p, m)) for m in months if m not in downloaded[p]]
+    return pd.concat([pd.concat(pieces[p]).sort_index() for p in params], axis=1)
 
 def calculate_cdd_hdd(df, base_temp=18.0):
-    df["CDD"] = (df["T2M"] - base_temp).clip(lower=0)
-    df["HDD"] = (base_temp - df["T2M"]).clip(lower=0)
+    delta = df["T2M"].to_numpy() - base_temp
+    cdd = np.maximum(delta, 0)
+    # max(-d, 0) == max(d, 0) - d
+    df["CDD"] = cdd
+    df["HDD"] = cdd - delta
     return df
 
+# Daily mean CDD/HDD per local day, grouped by day offset with np.bincount
+@st.cache_data(show_spinner=False)
+def calculate_daily_degree_days(station_data, station):
+    day = station_data.index.tz_localize(None).values.astype("datetime64[D]")
+    codes = (day - day[0]).astype(np.int64)
+    n_days = codes[-1] + 1
+    cdd, hdd = station_data["CDD"].to_numpy(), station_data["HDD"].to_numpy()
+    valid = ~np.isnan(cdd)
+    hours = np.bincount(codes[valid], minlength=n_days)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        daily_cdd = np.bincount(codes[valid], weights=cdd[valid], minlength=n_days) / hours
+        daily_hdd = np.bincount(codes[valid], weights=hdd[valid], minlength=n_days) / hours
+    dates = day[0] + np.arange(n_days)
+    return pd.DataFrame({
+        "Station": station,
+        "Date": dates,
+        "Year": (dates.astype("datetime64[Y]").astype(np.int64) + 1970).astype("int16"),
+        "CDD": daily_cdd.astype(np.float32),
+        "HDD": daily_hdd.astype(np.float32),
+    })
+
+# Derive calendar and CDD/HDD columns for one station's hourly data
+def prepare_station_data(station_data):
+    # Calendar fields from local wall time by datetime64 unit truncation
+    local = station_data.index.tz_localize(None).values
+    day = local.astype("datetime64[D]")
+    month_start = day.astype("datetime64[M]")
+    year_start = day.astype("datetime64[Y]")
+    station_data = station_data.assign(
+        Date=station_data.index,
+        Year=(year_start.astype(np.int64) + 1970).astype("int16"),
+        Month=(month_start.astype(np.int64) % 12 + 1).astype("int8"),
+        Day=((day - month_start.astype("datetime64[D]")).astype(np.int64) + 1).astype("int8"),
+        Hour=(local - day).astype("timedelta64[h]").astype("int8"),
+        DOY=((day - year_start.astype("datetime64[D]")).astype(np.int64) + 1).astype("int16"),
+    )
+    if "T2M" in station_data.columns:
+        station_data = calculate_cdd_hdd(station_data)
+    return station_data
+
+@st.cache_data(show_spinner=False, ttl=timedelta(days=1), max_entries=256)
+def load_station_data(lat, lon, start, end, params):
+    return prepare_station_data(fetch_nasa_power_data(lat, lon, start, end, params))
+
+# Keep each bucket's min and max, about n_out points per trace
+def downsample_minmax(df, y, group_cols, n_out=MAX_PLOT_POINTS):
+    parts = []
+    for _, group in df.groupby(group_cols, sort=False, observed=True):
+        values = group[y].reset_index(drop=True).dropna()
+        if len(values) <= n_out:
+            parts.append(group)
+            continue
+        buckets = values.index.to_numpy() * (n_out // 2) // len(group)
+        keep = np.union1d(values.groupby(buckets).idxmin(), values.groupby(buckets).idxmax())
+        parts.append(group.iloc[keep])
+    return pd.concat(parts) if parts else df
+
+# Plot each station's 5-95% band and median line per x value
+# q holds the 0.05/0.5/0.95 quantiles of y indexed by (Station, x)
+def plot_quantile_band(q, x, y, title):
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    palette = px.colors.qualitative.Plotly
+    fig = go.Figure()
+    for i, station in enumerate(q.index.get_level_values("Station").unique()):
+        band = q.xs(station, level="Station")
+        color = palette[i % len(palette)]
+        fig.add_trace(go.Scatter(x=band.index, y=band[0.95], mode="lines", line=dict(width=0, color=color),
+                                 legendgroup=station, showlegend=False, hoverinfo="skip"))
+        fig.add_trace(go.Scatter(x=band.index, y=band[0.05], mode="lines", line=dict(width=0, color=color),
+                                 fill="tonexty", opacity=0.3, legendgroup=station, showlegend=False, hoverinfo="skip"))
+        fig.add_trace(go.Scatter(x=band.index, y=band[0.5], mode="lines", line=dict(color=color),
+                                 name=station, legendgroup=station))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return fig
+
+# Gzip-compressed CSV of the raw table for download
+@st.cache_data(show_spinner=False)
+def encode_csv_gz(df):
+    sink = pa.BufferOutputStream()
+    with pa.CompressedOutputStream(sink, "gzip") as stream:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), stream)
+    return sink.getvalue().to_pybytes()
+
 # Tabs Setup
 if trigger:
     if not selected_stations or not selected_parameters:
         st.error("Please select at least one station and one parameter.")
+    elif start_date > end_date:
+        st.error("Start Date must be on or before End Date.")
     else:
+        import plotly.express as px
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
         tab_titles = ["Overview", "Intra-day/Month", "Yearly Comparison", "Day-of-Year Trends", "CDD/HDD Analysis", "Raw Data"]
         tabs = st.tabs(tab_titles)
 
-        raw_data_all = []
+        # Fetch every station concurrently
+        start_str, end_str = start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
+        params = tuple(code for label, code in PARAMETERS.items() if label in selected_parameters)
+        station_coords = load_station_coords()
+
+        fetched = {}
+        progress = st.progress(0.0, text="Fetching NASA POWER data...")
+        with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(selected_stations))) as executor:
+            futures = {
+                executor.submit(load_station_data, *station_coords[station], start_str, end_str, params): station
+                for station in selected_stations
+            }
+            # Streamlit elements can only be written from the script thread
+            for done, future in enumerate(as_completed(futures), 1):
+                station = futures[future]
+                try:
+                    fetched[station] = future.result()
+                # OSError covers requests' network errors as well as a failed cache write
+                except (OSError, ValueError) as exc:
+                    st.warning(f"Could not fetch data for {station}: {exc}")
+                progress.progress(done / len(futures), text="Fetching NASA POWER data...")
+        progress.empty()
+
+        raw_data_all = {}
         for station in selected_stations:
-            row = stations_df[stations_df["Station Name"] == station].iloc[0]
-            station_id, name, lat, lon = row["ID"], row["Station Name"], row["Latitude"], row["Longitude"]
-
-            station_data = pd.DataFrame()
-            for label in selected_parameters:
-                param_code = PARAMETERS[label]
-                df = fetch_nasa_power_data(lat, lon, start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d"), param_code)
-                if not df.empty:
-                    station_data = station_data.join(df, how="outer")
-
-            if not station_data.empty:
-                station_data["Station"] = name
-                station_data["Date"] = station_data.index
-                station_data["Year"] = station_data.index.year
-                station_data["Month"] = station_data.index.month
-                station_data["Day"] = station_data.index.day
-                station_data["Hour"] = station_data.index.hour
-                station_data["DOY"] = station_data.index.dayofyear
-                if "T2M" in station_data.columns:
-                    station_data = calculate_cdd_hdd(station_data)
-                raw_data_all.append(station_data)
+            if station in fetched and not fetched[station].empty:
+                raw_data_all[station] = fetched[station]
 
         if not raw_data_all:
             st.error("No data retrieved.")
         else:
-            df_all = pd.concat(raw_data_all)
+            df_all = pd.concat(raw_data_all.values(), ignore_index=True)
+            # Station as a categorical from per-block codes
+            station_codes = np.repeat(np.arange(len(raw_data_all), dtype=np.int16), [len(d) for d in raw_data_all.values()])
+            df_all.insert(df_all.columns.get_loc("Date"), "Station", pd.Categorical.from_codes(station_codes, categories=list(raw_data_all)))
+            df_all["Year"] = pd.Categorical(df_all["Year"])
 
             with tabs[0]:
                 st.subheader("Overview")
@@ -100,31 +306,58 @@ if trigger:
 
             with tabs[1]:
                 st.subheader("Intra-day & Intra-month Analysis")
-                fig = px.line(df_all, x="Hour", y=[c for c in df_all.columns if c in PARAMETERS.values()], color="Station")
-                st.plotly_chart(fig, use_container_width=True)
+                cols = [col for col in PARAMETERS.values() if col in df_all.columns]
+                hourly_q = df_all.groupby(["Station", "Hour"], observed=True)[cols].quantile([0.05, 0.5, 0.95])
+                for col in cols:
+                    fig = plot_quantile_band(hourly_q[col].unstack(), "Hour", col, title=f"Hourly Distribution of {col}")
+                    st.plotly_chart(fig, use_container_width=True)
 
             with tabs[2]:
                 st.subheader("Yearly Comparison")
-                for col in PARAMETERS.values():
-                    if col in df_all.columns:
-                        fig = px.box(df_all, x="Year", y=col, color="Station", title=f"Yearly Distribution of {col}")
-                        st.plotly_chart(fig, use_container_width=True)
+                cols = [col for col in PARAMETERS.values() if col in df_all.columns]
+                fig = make_subplots(rows=len(cols), cols=1, subplot_titles=[f"Yearly Distribution of {col}" for col in cols])
+                palette = px.colors.qualitative.Plotly
+                for i, (station, sub) in enumerate(df_all.groupby("Station", observed=True, sort=False)):
+                    for row, col in enumerate(cols, 1):
+                        q = sub.groupby("Year", observed=True)[col].quantile([0.25, 0.5, 0.75]).unstack()
+                        # Tukey whiskers as px.box draws them: the most extreme samples within 1.5 IQR of the box
+                        reach = 1.5 * (q[0.75] - q[0.25])
+                        low = (q[0.25] - reach).reindex(sub["Year"]).to_numpy()
+                        high = (q[0.75] + reach).reindex(sub["Year"]).to_numpy()
+                        values = sub[col]
+                        whiskers = values.where((values >= low) & (values <= high)).groupby(sub["Year"], observed=True).agg(["min", "max"])
+                        fig.add_trace(go.Box(x=q.index.to_numpy(), lowerfence=whiskers["min"], q1=q[0.25], median=q[0.5], q3=q[0.75],
+                                             upperfence=whiskers["max"], name=station, legendgroup=station, showlegend=(row == 1),
+                                             marker_color=palette[i % len(palette)]),
+                                      row=row, col=1)
+                fig.update_layout(boxmode="group", height=400 * len(cols))
+                fig.update_xaxes(type="category")
+                st.plotly_chart(fig, use_container_width=True)
 
             with tabs[3]:
                 st.subheader("Day-of-Year Trends")
                 for col in PARAMETERS.values():
                     if col in df_all.columns:
-                        fig = px.line(df_all, x="DOY", y=col, color="Year", facet_col="Station", title=f"{col} Trends by Day of Year")
+                        plot_df = downsample_minmax(df_all[["Station", "Year", "DOY", col]], col, ["Station", "Year"])
+                        fig = px.line(plot_df, x="DOY", y=col, color="Year", facet_col="Station", title=f"{col} Trends by Day of Year", render_mode="webgl")
                         st.plotly_chart(fig, use_container_width=True)
 
             with tabs[4]:
                 st.subheader("CDD & HDD Analysis")
-                cdd_fig = px.line(df_all, x="Date", y="CDD", color="Year", facet_col="Station", title="Daily CDD Comparison")
-                hdd_fig = px.line(df_all, x="Date", y="HDD", color="Year", facet_col="Station", title="Daily HDD Comparison")
-                st.plotly_chart(cdd_fig, use_container_width=True)
-                st.plotly_chart(hdd_fig, use_container_width=True)
+                daily_frames = [calculate_daily_degree_days(d, station) for station, d in raw_data_all.items() if "CDD" in d.columns]
+                if not daily_frames:
+                    st.info("Select Temperature (T2M) to compute CDD/HDD.")
+                else:
+                    daily_dd = pd.concat(daily_frames, ignore_index=True)
+                    daily_dd["Station"] = pd.Categorical(daily_dd["Station"], categories=df_all["Station"].cat.categories)
+                    daily_dd["Year"] = pd.Categorical(daily_dd["Year"])
+                    dd_long = daily_dd.melt(id_vars=["Station", "Date", "Year"], value_vars=["CDD", "HDD"], var_name="Metric", value_name="Degree Days")
+                    fig = px.line(dd_long, x="Date", y="Degree Days", color="Year", facet_row="Metric", facet_col="Station",
+                                  title="Daily CDD & HDD Comparison", render_mode="webgl")
+                    fig.update_yaxes(matches=None, showticklabels=True)
+                    st.plotly_chart(fig, use_container_width=True)
 
             with tabs[5]:
                 st.subheader("Raw Data")
                 st.dataframe(df_all)
-                st.download_button("Download as CSV", df_all.to_csv(index=False), "weather_data.csv")
+                st.download_button("Download as CSV (gzip)", encode_csv_gz(df_all), "weather_data.csv.gz", mime="application/gzip")
@@ -0,0 +1,9 @@
+import pandas as pd
+
+# One-time export of the editable station workbook to the Parquet file the dashboard loads.
+# Re-run after editing stations.xlsx. pandas already opens openpyxl workbooks read-only with cached
+# values (read_only=True, data_only=True), so no engine_kwargs are needed.
+COLUMNS = ["ID", "Station Name", "Latitude", "Longitude"]
+
+if __name__ == "__main__":
+    pd.read_excel("stations.xlsx", engine="openpyxl", usecols=COLUMNS).to_parquet("stations.parquet", index=False)